@@ -1,27 +1,67 @@
-import datetime
-import json
+import functools
 import logging
 import aiohttp
 import asyncio
-from typing import Union
+import yarl
+from typing import ClassVar, Dict, Union
+
+from heartbridge._clock import now_cached
+from heartbridge._codec import dumps, loads
 
 logger = logging.getLogger(__name__)
 
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+@functools.lru_cache(maxsize=1024)
+def _endpoint_url(base_url: str, endpoint: str) -> yarl.URL:
+    # Parsed once per endpoint so aiohttp doesn't re-parse the URL on every request
+    return yarl.URL(f"{base_url}/{endpoint}")
+
 
 class RESTClient:
+    # One session (and keep-alive pool) per event loop, shared by every client
+    _sessions: ClassVar[Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession]] = {}
+
     def __init__(self, url: str):
         self._base_url = url
-        self._session = aiohttp.ClientSession()
 
-    async def _post(self, endpoint: str, data: str):
-        async with self._session.post(
-            self._base_url + "/" + endpoint, data=data
+    @classmethod
+    def _get_session(cls) -> aiohttp.ClientSession:
+        loop = asyncio.get_event_loop()
+        session = cls._sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=200,
+                    limit_per_host=50,
+                    keepalive_timeout=75,
+                    ttl_dns_cache=300,
+                )
+            )
+            cls._sessions[loop] = session
+        return session
+
+    @classmethod
+    async def shutdown_pool(cls):
+        """ Close the session shared by the clients on the current event loop """
+        session = cls._sessions.pop(asyncio.get_event_loop(), None)
+        if session is not None:
+            await session.close()
+
+    async def _post(self, endpoint: str, data: bytes):
+        async with self._get_session().post(
+            _endpoint_url(self._base_url, endpoint),
+            data=data,
+            headers=_JSON_HEADERS,
         ) as resp:
-            return await resp.json()
+            return await resp.json(loads=loads)
 
     async def _get(self, endpoint: str):
-        async with self._session.get(self._base_url + "/" + endpoint) as resp:
-            return await resp.json()
+        async with self._get_session().get(
+            _endpoint_url(self._base_url, endpoint)
+        ) as resp:
+            return await resp.json(loads=loads)
 
     async def register(
         self,
@@ -35,14 +75,14 @@ class RESTClient:
 
         if type(performance_date) is int:
             if performance_date < 0:
-                performance_date = int(datetime.datetime.now().timestamp())
+                performance_date = int(now_cached())
             logger.info("Requesting token for time %d", performance_date)
         else:
             logger.info("Requesting token for time %s", performance_date)
 
         return await self._post(
             "register",
-            json.dumps(
+            dumps(
                 {
                     "action": "register",
                     "artist": artist,
@@ -56,9 +96,8 @@ class RESTClient:
         )
 
     async def update(self, token, updated_info):
-        cmd_json = {"action": "update", "token": token}
-        merged_json = {**cmd_json, **updated_info}
-        return await self._post("update", json.dumps(merged_json))
+        cmd_json = {"action": "update", "token": token, **updated_info}
+        return await self._post("update", dumps(cmd_json))
 
     async def get_event_details(self, performance_id: str):
         return await self._get(f"events/{performance_id}")
@@ -72,11 +111,12 @@ class RESTClient:
     async def set_event_status(self, performance_id: str, token: str, status: str):
         return await self._post(
             f"events/{performance_id}/status",
-            json.dumps({"token": token, "status": status}),
+            dumps({"token": token, "status": status}),
         )
 
     async def delete_performance(self, token: str):
-        return await self._post("delete", json.dumps({"token": token}))
+        return await self._post("delete", dumps({"token": token}))
 
     async def close(self):
-        await self._session.close()
+        # The session is shared between clients, see shutdown_pool()
+        pass
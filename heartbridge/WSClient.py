@@ -1,16 +1,44 @@
 import asyncio
-import datetime
-import json
+import copy
 import logging
+import socket
 import websockets
+from typing import Optional, Tuple, Union
+
+from heartbridge._clock import now_cached
+from heartbridge._codec import MSGPACK_SUBPROTOCOL, dumps, wire_codec
 
 logger = logging.getLogger(__name__)
 
 
+def _frame_head(action: str, field: str) -> str:
+    # '{"action":"<action>","<field>":' -- the value and closing brace get appended
+    return '{"action":%s,%s:' % (dumps(action).decode(), dumps(field).decode())
+
+
 class WSClient:
-    def __init__(self, url):
+    # Frame templates for the JSON wire format, built once when the class is created
+    _SUBSCRIBE_HEAD = _frame_head("subscribe", "performance_id")
+    _PUBLISH_HEAD = _frame_head("publish", "token")
+
+    def __init__(
+        self, url, wire_format: str = "json", compression: Optional[str] = "deflate"
+    ):
         self._websocket_url = url
+        # permessage-deflate only pays off for larger (e.g. batched) frames
+        self._compression = compression
         self._ws: websockets.WebSocketClientProtocol = None
+        self._connection_id = None
+        self._rx_queue: asyncio.Queue = None
+        self._reader_task: asyncio.Task = None
+        # Why the connection ended, raised by wait_for_data once the queue runs dry
+        self._rx_error: Optional[Exception] = None
+        self._wire_format = wire_format
+        # (token, prefix) for the last token published with; a client usually sticks
+        # to one token, and update() hands out a new one each time, so keep just that
+        self._publish_prefix: Optional[Tuple[str, str]] = None
+        self._encode, self._decode = wire_codec(wire_format)
+        self._subprotocols = [MSGPACK_SUBPROTOCOL] if wire_format == "msgpack" else None
 
     @property
     def is_connected(self):
@@ -20,16 +48,39 @@ class WSClient:
 
     @property
     def connection_id(self):
-        return self._ws.request_headers["Sec-WebSocket-Key"]
+        return self._connection_id
 
     async def connect(self, url=None, max_retries=10):
         retry_count = 0
         if url:
             self._websocket_url = url
+        # The old reader would otherwise pick up frames from the new connection
+        await self._stop_reader()
 
         while True:
             try:
-                self._ws = await websockets.connect(self._websocket_url)
+                self._ws = await websockets.connect(
+                    self._websocket_url,
+                    subprotocols=self._subprotocols,
+                    compression=self._compression,
+                )
+                negotiated = self._ws.subprotocol
+                if self._subprotocols and negotiated not in self._subprotocols:
+                    # The server would read the binary frames as malformed JSON
+                    await self._ws.close()
+                    raise ValueError(
+                        "Server did not accept the %s subprotocol" % MSGPACK_SUBPROTOCOL
+                    )
+                self._connection_id = self._ws.request_headers["Sec-WebSocket-Key"]
+
+                # Don't let Nagle hold back the small publish frames
+                sock = self._ws.transport.get_extra_info("socket")
+                if sock is not None:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                self._rx_queue = asyncio.Queue(maxsize=1024)
+                self._rx_error = None
+                self._reader_task = asyncio.ensure_future(self._reader_loop())
                 return
             except (websockets.InvalidStatusCode, ConnectionResetError) as e:
                 retry_count += 1
@@ -41,30 +92,113 @@ class WSClient:
                 )
                 await asyncio.sleep(retry_count)
 
+    async def _reader_loop(self):
+        # Drain frames off the socket as they arrive so callers pick them up from the queue
+        while True:
+            try:
+                frame = await self._ws.recv()
+            except asyncio.CancelledError:
+                # Only an Exception before 3.8, and it must not be queued as a failure
+                raise
+            except Exception as e:
+                # Hand the failure (usually ConnectionClosed) over to whoever is waiting
+                self._set_rx_error(e)
+                return
+            await self._rx_queue.put(frame)
+
+    def _set_rx_error(self, error: Exception):
+        if self._rx_error is None:
+            self._rx_error = error
+        # Only wake a waiter blocked on an empty queue; when the queue is full
+        # wait_for_data finds _rx_error once it has drained the frames
+        if not self._rx_queue.full():
+            self._rx_queue.put_nowait(error)
+
+    async def _stop_reader(self):
+        # A reader blocked on a full queue stops calling recv(), so it has to be
+        # cancelled rather than left to notice the closed socket
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+
     async def close(self):
+        await self._stop_reader()
         if self._ws:
             try:
                 await self._ws.close()
             except RuntimeError:
                 pass  # Ignore runtime errors if the socket is getting shut down anyways
+            if self._rx_queue is not None:
+                # The reader is gone, so report the closed connection to wait_for_data
+                self._set_rx_error(await self._closed_error())
+
+    async def _closed_error(self) -> Exception:
+        # recv() on a closed socket returns any frames still buffered, then raises the
+        # same ConnectionClosed the reader would have handed over
+        try:
+            while True:
+                await asyncio.wait_for(self._ws.recv(), 1.0)
+        except Exception as e:
+            return e
+
+    def _raise_rx_error(self):
+        # Each caller gets its own copy, so the stored exception's traceback doesn't
+        # grow with every wait_for_data
+        try:
+            error = copy.copy(self._rx_error)
+        except TypeError:
+            # Older websockets raise exceptions that can't be rebuilt from their args
+            raise self._rx_error.with_traceback(None)
+        raise error from self._rx_error
 
     async def subscribe(self, performance_id):
         logger.info("Subscribing to Performance ID: %s", performance_id)
+        await self._ws.send(self.subscribe_frame(performance_id))
+
+    def subscribe_frame(self, performance_id):
+        """ Serialize a subscribe frame once, for send_frame on many clients """
+        if self._wire_format == "json":
+            return self._SUBSCRIBE_HEAD + self._encode(performance_id) + "}"
+        return self._encode({"action": "subscribe", "performance_id": performance_id})
+
+    async def unsubscribe(self, performance_id):
+        # Lets a connection be reused for another performance without reconnecting
+        logger.info("Unsubscribing from Performance ID: %s", performance_id)
+        await self._ws.send(self.unsubscribe_frame(performance_id))
+
+    def unsubscribe_frame(self, performance_id):
+        return self._encode({"action": "unsubscribe", "performance_id": performance_id})
+
+    async def send_frame(self, frame):
+        """ Send a frame serialized by a client using the same wire format """
+        await self._ws.send(frame)
+
+    async def subscribe_many(self, performance_ids):
+        # Requires a server that understands subscribe_batch; one frame instead of N
+        logger.info("Subscribing to Performance IDs: %s", performance_ids)
         await self._ws.send(
-            json.dumps({"action": "subscribe", "performance_id": performance_id})
+            self._encode(
+                {"action": "subscribe_batch", "performance_ids": list(performance_ids)}
+            )
         )
 
     async def register(
         self,
         artist: str,
         title: str,
-        performance_date: int = int(datetime.datetime.now().timestamp()),
+        performance_date: int = -1,
         duration=90,
     ):
+        if performance_date < 0:
+            performance_date = int(now_cached())
         logger.info("Requesting token for time %d", performance_date)
 
         await self._ws.send(
-            json.dumps(
+            self._encode(
                 {
                     "action": "register",
                     "artist": artist,
@@ -75,21 +209,61 @@ class WSClient:
             )
         )
 
-        return await self._ws.recv()
+        return await self.wait_for_data()
 
     async def update(self, token, updated_info):
-        cmd_json = {"action": "update", "token": token}
+        cmd_json = {"action": "update", "token": token, **updated_info}
 
-        await self._ws.send(json.dumps({**cmd_json, **updated_info}))
-        return await self._ws.recv()
+        await self._ws.send(self._encode(cmd_json))
+        return await self.wait_for_data()
 
     async def publish(self, token, heartrate):
+        if self._wire_format == "json" and type(heartrate) is int:
+            await self.publish_fast(self.publish_prefix(token), heartrate)
+            return
+
         cmd_json = {"action": "publish", "heartrate": heartrate, "token": token}
 
-        await self._ws.send(json.dumps(cmd_json))
+        await self._ws.send(self._encode(cmd_json))
+
+    def publish_prefix(self, token) -> str:
+        """ Pre-serialize the invariant part of a publish frame for use with publish_fast """
+        if self._publish_prefix is not None and self._publish_prefix[0] == token:
+            return self._publish_prefix[1]
+        if self._wire_format != "json":
+            raise ValueError("publish_fast requires the json wire format")
+        prefix = self._PUBLISH_HEAD + self._encode(token) + ',"heartrate":'
+        self._publish_prefix = (token, prefix)
+        return prefix
+
+    async def publish_fast(self, prefix: str, heartrate: Union[int, str]):
+        # heartrate may also be given as its already formatted decimal text
+        await self._ws.send(prefix + str(heartrate) + "}")
+
+    async def publish_batch(self, token, samples):
+        cmd_json = {"action": "publish_batch", "token": token, "samples": samples}
+
+        await self._ws.send(self._encode(cmd_json))
 
     async def wait_for_data(self):
-        return await self._ws.recv()
+        if self._rx_error is not None and self._rx_queue.empty():
+            self._raise_rx_error()
+        frame = await self._rx_queue.get()
+        if isinstance(frame, Exception):
+            # Leave it queued so any later waiters see the closed connection as well
+            self._rx_queue.put_nowait(frame)
+            self._raise_rx_error()
+        return frame
+
+    def reset(self):
+        """ Drop any received frames that haven't been consumed yet """
+        # A closed connection stays visible to wait_for_data through _rx_error
+        while not self._rx_queue.empty():
+            self._rx_queue.get_nowait()
+
+    def decode(self, frame):
+        """ Decode a received frame using the wire format negotiated for this client """
+        return self._decode(frame)
 
     def peek_rx(self):
-        return len(self._ws.frame_buffer.recv_buffer)
+        return self._rx_queue.qsize()
@@ -0,0 +1,13 @@
+import time
+
+# (monotonic time of the last read, wall clock time read at that point)
+_last_read = (float("-inf"), 0.0)
+
+
+def now_cached(max_age: float = 0.05) -> float:
+    """ Wall clock time in seconds, re-read from the system at most once every max_age seconds """
+    global _last_read
+    mono = time.monotonic()
+    if mono - _last_read[0] >= max_age:
+        _last_read = (mono, time.time())
+    return _last_read[1]
@@ -0,0 +1,30 @@
+try:
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    import json
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    loads = json.loads
+
+
+MSGPACK_SUBPROTOCOL = "hb.msgpack.v1"
+
+
+def wire_codec(wire_format: str):
+    """ Return the (encode, decode) pair used for WebSocket frames in the given wire format """
+    if wire_format == "json":
+        return (lambda obj: dumps(obj).decode()), loads
+    if wire_format == "msgpack":
+        # Only required when MessagePack has been asked for
+        import msgspec
+
+        return msgspec.msgpack.encode, msgspec.msgpack.Decoder().decode
+    raise ValueError(f"Unsupported wire format: {wire_format}")
@@ -8,4 +8,5 @@ setuptools.setup(
     description="Heartbridge WebSocket Client API",
     packages=setuptools.find_packages(),
     python_requires=">=3.6",
+    extras_require={"fast": ["uvloop", "orjson", "msgspec"]},
 )
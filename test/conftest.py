@@ -1,5 +1,10 @@
+import asyncio
+import datetime
+import sys
 import pytest
 
+from helpers import BAD_DATE_OFFSETS
+
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -10,12 +15,39 @@ def pytest_addoption(parser):
     )
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def url(request):
     return request.config.getoption("--url")
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def wsurl(url):
-    if url[0:4] == "http":
-        return "ws" + url[4:]
+    # http:// -> ws:// and https:// -> wss://, anything else is used as given
+    return "ws" + url[4:] if url.startswith("http") else url
+
+
+@pytest.fixture(scope="session")
+def event_loop_policy():
+    # Run the async tests on uvloop when it is installed (pip install .[fast])
+    if sys.platform != "win32":
+        try:
+            import uvloop
+        except ImportError:
+            pass
+        else:
+            return uvloop.EventLoopPolicy()
+    return asyncio.DefaultEventLoopPolicy()
+
+
+@pytest.fixture(scope="session")
+def event_loop(event_loop_policy):
+    # A single loop for the whole run lets the client fixtures be session scoped
+    loop = event_loop_policy.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(params=BAD_DATE_OFFSETS)
+def bad_date(request):
+    # Resolved when the test runs rather than at collection so it can't go stale
+    return datetime.datetime.now() + request.param
@@ -0,0 +1,25 @@
+import datetime
+import functools
+import jwt
+
+# Field values the server is expected to reject as too long
+BAD_ARTIST = "A" * 65
+BAD_TITLE = "B" * 65
+LONG_ARTIST = "DJFurioso" * 65
+# Too far in the past, and too far in the future
+BAD_DATE_OFFSETS = (datetime.timedelta(minutes=-6), datetime.timedelta(days=367))
+
+
+@functools.lru_cache(maxsize=1024)
+def decode_token(token: str) -> dict:
+    # Claims for a given token never change, so only decode each one once
+    return jwt.decode(token, options={"verify_signature": False})
+
+
+def is_error(response) -> bool:
+    # REST responses arrive decoded, WebSocket frames as the raw text
+    if isinstance(response, dict):
+        return "error" in response
+    if isinstance(response, bytes):
+        return b'"error"' in response
+    return '"error"' in response
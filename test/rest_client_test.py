@@ -1,11 +1,14 @@
 import pytest
 import logging
 import heartbridge
-import jwt
-import json
+import orjson
 import random
 import datetime
 import asyncio
+import os
+import time
+
+from helpers import BAD_ARTIST, BAD_TITLE, LONG_ARTIST, decode_token, is_error
 
 # Some Mock performance information to be used for token generation and checking
 MOCK_ARTIST = "DJFury"
@@ -13,40 +16,89 @@ MOCK_TITLE = "Dougie's Furry Beats"
 MOCK_EMAIL = "dougie.j.fleabottom@furiousenterprises.net"
 MOCK_DESCRIPTION = "The furriest beats in music right meow"
 
+# Keyword arguments for registering a long-lived mock performance
+_REGISTER_KW = dict(
+    artist=MOCK_ARTIST,
+    title=MOCK_TITLE,
+    email=MOCK_EMAIL,
+    description=MOCK_DESCRIPTION,
+    duration=90,
+)
+# Duration (minutes) for performances that a test waits on to expire
+_SHORT_DURATION = 1
+
 
-@pytest.fixture()
+@pytest.fixture(scope="session")
 async def client(url) -> heartbridge.RESTClient:
     logging.debug("Using %s for REST API", url)
     c = heartbridge.RESTClient(url)
     yield c
     await c.close()
+    await heartbridge.RESTClient.shutdown_pool()
+
+
+async def _wait_for_expiry(
+    client: heartbridge.RESTClient, performance_id: str, timeout: float = 65.0
+) -> bool:
+    """ Poll until the server no longer knows the performance, False on timeout """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        details = await client.get_event_details(performance_id)
+        if is_error(details):
+            return True
+        await asyncio.sleep(1.0)
+    return False
+
+
+@pytest.fixture(scope="session")
+async def token_pool(request, client: heartbridge.RESTClient):
+    # One token per collected test in this module that takes one (the ws tests have
+    # their own token fixture); pytest-xdist workers each collect everything but only
+    # run their share, and the token fixture covers any shortfall
+    num_tokens = sum(
+        "token" in item.fixturenames
+        for item in request.session.items
+        if item.module.__name__ == __name__
+    )
+    num_workers = int(os.environ.get("PYTEST_XDIST_WORKER_COUNT", 1))
+    pool_size = -(-num_tokens // num_workers)
+    logging.debug("Requesting %d tokens", pool_size)
+
+    # Register the performances concurrently rather than one round trip per test
+    ret_val = await asyncio.gather(
+        *(client.register(**_REGISTER_KW) for _ in range(pool_size))
+    )
+
+    logging.debug("Returned payloads: %s", ret_val)
+    yield list(ret_val)
 
 
 @pytest.fixture()
-async def token(client: heartbridge.RESTClient):
-    logging.debug("Requesting new token")
+async def token(client: heartbridge.RESTClient, token_pool):
+    # Each pooled token is handed out once, so tests are free to update or delete it
+    if token_pool:
+        yield token_pool.pop()
+        return
 
-    # Get a token for right now
-    ret_val = await client.register(
-        artist=MOCK_ARTIST,
-        title=MOCK_TITLE,
-        email=MOCK_EMAIL,
-        description=MOCK_DESCRIPTION,
-        duration=1,
-    )
+    logging.debug("Token pool exhausted, requesting new token")
+    ret_val = await client.register(**_REGISTER_KW)
+
+    logging.debug("Returned payload: %s", ret_val)
+    yield ret_val
+
+
+@pytest.fixture()
+async def fresh_token(client: heartbridge.RESTClient):
+    # Shortest duration the server accepts, for the tests that wait for expiry
+    logging.debug("Requesting new token with duration %d", _SHORT_DURATION)
+
+    ret_val = await client.register(**dict(_REGISTER_KW, duration=_SHORT_DURATION))
 
     logging.debug("Returned payload: %s", ret_val)
     yield ret_val
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize(
-    "bad_date",
-    [
-        datetime.datetime.now() - datetime.timedelta(minutes=6),
-        datetime.datetime.now() + datetime.timedelta(days=367),
-    ],
-)
 async def test_rest_register_bad_date(client, bad_date):
     ret = await client.register(
         artist=MOCK_ARTIST,
@@ -57,21 +109,21 @@ async def test_rest_register_bad_date(client, bad_date):
         duration=1,
     )
     logging.debug(ret)
-    assert "error" in json.dumps(ret)
+    assert is_error(ret)
 
 
 @pytest.mark.asyncio
 async def test_rest_register_bad_artist(client):
     ret = await client.register(
-        artist="A" * 65,
-        title="B" * 65,
+        artist=BAD_ARTIST,
+        title=BAD_TITLE,
         email=MOCK_EMAIL,
         description=MOCK_DESCRIPTION,
         duration=1,
         performance_date=datetime.datetime.now().timestamp(),
     )
     logging.debug(ret)
-    assert "error" in json.dumps(ret)
+    assert is_error(ret)
 
 
 def test_rest_register(token):
@@ -85,7 +137,7 @@ def test_rest_register(token):
     assert len(performance_id) == 6
 
     # Decode the token
-    token_claims = jwt.decode(token["token"], verify=False)
+    token_claims = decode_token(token["token"])
     logging.debug(token_claims)
 
     assert token_claims["artist"] == MOCK_ARTIST
@@ -116,7 +168,7 @@ async def test_rest_register_timestring(client: heartbridge.RESTClient):
     assert len(performance_id) == 6
 
     # Decode the token
-    token_claims = jwt.decode(token["token"], verify=False)
+    token_claims = decode_token(token["token"])
     logging.debug(token_claims)
 
     assert token_claims["artist"] == MOCK_ARTIST
@@ -137,14 +189,11 @@ async def test_rest_update(client, token, field, new_value):
     performance_id = token["performance_id"]
     logging.info("PerformanceID: %s", performance_id)
 
-    orig_token_claims = jwt.decode(token["token"], verify=False)
-    logging.debug(orig_token_claims)
-
     # Update the field information
     ret_val = await client.update(token["token"], {field: new_value})
 
     # Make sure an error wasn't returned
-    if "error" in ret_val:
+    if is_error(ret_val):
         logging.debug(ret_val)
         assert False
 
@@ -152,7 +201,7 @@ async def test_rest_update(client, token, field, new_value):
     assert ret_val["performance_id"] == performance_id
 
     # Check to make sure the new artist information is in the new token
-    new_token_claims = jwt.decode(ret_val["token"], verify=False)
+    new_token_claims = decode_token(ret_val["token"])
     logging.debug(new_token_claims)
     assert new_token_claims[field] == new_value
 
@@ -160,23 +209,18 @@ async def test_rest_update(client, token, field, new_value):
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
     "field,new_value",
-    [("artist", "DJFurioso" * 65), ("token", "ABC123456890"), ("performance_date", 0)],
+    [("artist", LONG_ARTIST), ("token", "ABC123456890"), ("performance_date", 0)],
 )
 async def test_rest_update_bad_values(client, token, field, new_value):
     """ Register a performance, then update information with bad values """
     performance_id = token["performance_id"]
     logging.info("PerformanceID: %s", performance_id)
 
-    orig_token_claims = jwt.decode(token["token"], verify=False)
-    logging.debug(orig_token_claims)
-
     # Update the field information
     ret_val = await client.update(token["token"], {field: new_value})
 
     # Make sure an error was returned
-    assert "error" in json.dumps(
-        ret_val
-    ), "Oops, we expected to get an error returned here"
+    assert is_error(ret_val), "Oops, we expected to get an error returned here"
 
 
 @pytest.mark.asyncio
@@ -186,9 +230,7 @@ async def test_rest_fetch_non_existent_performance_details(
     """ Have a client attempt to fetch a bogus performance id, expectation is it fails """
     ret_val = await client.get_event_details("AAAAAA")
     logging.debug(ret_val)
-    assert "error" in json.dumps(
-        ret_val
-    ), "Oops, we expected to get an error returned here"
+    assert is_error(ret_val), "Oops, we expected to get an error returned here"
 
 
 @pytest.mark.asyncio
@@ -205,10 +247,11 @@ async def test_rest_fetch_performance_details(client: heartbridge.RESTClient, to
     assert details["description"] == MOCK_DESCRIPTION
 
 
+@pytest.mark.slow
 @pytest.mark.asyncio
-async def test_rest_expire_performance(client: heartbridge.RESTClient, token):
+async def test_rest_expire_performance(client: heartbridge.RESTClient, fresh_token):
     """ Register a performance and wait 1 minute to ensure it has expired """
-    performance_id = token["performance_id"]
+    performance_id = fresh_token["performance_id"]
     logging.info("PerformanceID: %s", performance_id)
 
     details = await client.get_event_details(performance_id)
@@ -218,12 +261,9 @@ async def test_rest_expire_performance(client: heartbridge.RESTClient, token):
     assert details["email"] == MOCK_EMAIL
     assert details["description"] == MOCK_DESCRIPTION
 
-    await asyncio.sleep(61)
-
-    details = await client.get_event_details(performance_id)
-    assert "error" in json.dumps(
-        details
-    ), "Oops, we expected to get an error returned here"
+    assert await _wait_for_expiry(
+        client, performance_id
+    ), "Oops, we expected the performance to expire"
 
 
 @pytest.mark.asyncio
@@ -264,19 +304,18 @@ async def test_rest_delete_performance_twice(client: heartbridge.RESTClient, tok
     assert ret_val["status"] == "success"
 
     ret_val = await client.delete_performance(token["token"])
-    assert "error" in json.dumps(
-        ret_val
-    ), "Oops, we expected to get an error returned here"
+    assert is_error(ret_val), "Oops, we expected to get an error returned here"
 
 
+@pytest.mark.slow
 @pytest.mark.asyncio
-async def test_rest_delete_expired_performance(client: heartbridge.RESTClient, token):
+async def test_rest_delete_expired_performance(
+    client: heartbridge.RESTClient, fresh_token
+):
     """" Register a new performance, wait for it to expire, then attempt to delete it """
-    await asyncio.sleep(61)
-    ret_val = await client.delete_performance(token["token"])
-    assert "error" in json.dumps(
-        ret_val
-    ), "Oops, we expected to get an error returned here"
+    assert await _wait_for_expiry(client, fresh_token["performance_id"])
+    ret_val = await client.delete_performance(fresh_token["token"])
+    assert is_error(ret_val), "Oops, we expected to get an error returned here"
 
 
 @pytest.mark.asyncio
@@ -285,18 +324,14 @@ async def test_rest_delete_bogus_token(client: heartbridge.RESTClient):
     ret_val = await client.delete_performance(
         "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
     )
-    assert "error" in json.dumps(
-        ret_val
-    ), "Oops, we expected to get an error returned here"
+    assert is_error(ret_val), "Oops, we expected to get an error returned here"
 
 
 @pytest.mark.asyncio
 async def test_rest_get_bogus_status(client: heartbridge.RESTClient):
     """ Attempt to get the status of a performance that hasn't been registered """
     ret_val = await client.get_event_status("AAAAAA")
-    assert "error" in json.dumps(
-        ret_val
-    ), "Oops, we expected to get an error returned here"
+    assert is_error(ret_val), "Oops, we expected to get an error returned here"
 
 
 @pytest.mark.asyncio
@@ -332,7 +367,7 @@ async def test_rest_set_status_and_observe(
     # Keep taking in messages until a status update comes through
     while True:
         ret_val = await wsclient.wait_for_data()
-        p = json.loads(ret_val)
+        p = orjson.loads(ret_val)
         if p["action"] == "performance_status_update":
             break
 
@@ -345,7 +380,7 @@ async def test_rest_set_status_and_observe(
     # Wait for the next status update message
     while True:
         ret_val = await wsclient.wait_for_data()
-        p = json.loads(ret_val)
+        p = orjson.loads(ret_val)
         if p["action"] == "performance_status_update":
             break
 
@@ -1,50 +1,228 @@
+import array
 import pytest
 import logging
 import heartbridge
-import jwt
-import json
+from heartbridge._clock import now_cached
+import websockets
+import orjson
 import random
 import datetime
 import asyncio
+import contextlib
+import time
+from typing import Optional
+
+from helpers import BAD_ARTIST, BAD_TITLE, LONG_ARTIST, decode_token, is_error
 
 # Some Mock performance information to be used for token generation and checking
 MOCK_ARTIST = "DJFury"
 MOCK_TITLE = "Dougie's Furry Beats"
 
+# Keyword arguments for registering a mock performance
+_REGISTER_KW = dict(artist=MOCK_ARTIST, title=MOCK_TITLE, duration=1)
+
+_log = logging.getLogger(__name__)
+
+# Heart rates are drawn up front into a ring of this (power of two) size
+_HR_RING_SIZE = 4096
+# Decimal text for every heart rate the Publisher can draw, indexed by rate - 60
+_HR_STRS = tuple(str(hr) for hr in range(60, 181))
+
+
+def _peek_action(frame: str) -> Optional[str]:
+    # Pull out the "action" value without parsing the rest of the frame
+    i = frame.find('"action"')
+    if i < 0:
+        return None
+    j = frame.find('"', i + len('"action"'))
+    if j < 0:
+        return None
+    return frame[j + 1 : frame.find('"', j + 1)]
+
 
 class Publisher:
     def __init__(self, client: heartbridge.WSClient, token):
         self.client: heartbridge.WSClient = client
         self.token = token["token"]
         self.performance_id = token["performance_id"]
+        self._publish_prefix = client.publish_prefix(self.token)
+        self._batch = False
+        self._batch_window = 0.05
+        randrange = random.Random().randrange
+        self._heart_rates = array.array(
+            "i", (randrange(60, 181) for _ in range(_HR_RING_SIZE))
+        )
+        self._hr_index = 0
         self._interval = 1.0
         self._running = False
         self.total_events_published = 0
+        self._target: Optional[int] = None
+        self._reached_event = asyncio.Event()
+        self._outq: asyncio.Queue = asyncio.Queue(maxsize=64)
         self._run_task = None
+        self._send_task = None
+        self._wakeup = asyncio.Event()
 
     async def _thread_func(self):
         logging.debug("Publisher thread running")
+        next_tick = time.monotonic() + self._interval
         while self._running:
-            logging.debug("Publisher thread publishing")
-            heart_rate = random.randint(60, 180)
-            await self.client.publish(self.token, heart_rate)
-            self.total_events_published += 1
-            await asyncio.sleep(self._interval)
+            heart_rate = self._heart_rates[self._hr_index & (_HR_RING_SIZE - 1)]
+            self._hr_index += 1
+            await self._outq.put(heart_rate)
 
-    async def start(self, interval: float = 1.0):
+            # Sleep only for what's left of this period so the cadence doesn't drift,
+            # stop() cuts the sleep short through _wakeup
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), max(0.0, next_tick - time.monotonic())
+                )
+            except asyncio.TimeoutError:
+                pass
+            next_tick += self._interval
+
+        # Tell the sender there's nothing more coming
+        await self._outq.put(None)
+
+    async def _sender(self):
+        # Single consumer that owns the connection, fed by _thread_func through _outq
+        while True:
+            heart_rate = await self._outq.get()
+            if heart_rate is None:
+                return
+            try:
+                if not self._batch:
+                    await self.client.publish_fast(
+                        self._publish_prefix, _HR_STRS[heart_rate - 60]
+                    )
+                    self.total_events_published += 1
+                else:
+                    samples = await self._collect_batch(heart_rate)
+                    await self.client.publish_batch(self.token, samples)
+                    self.total_events_published += len(samples)
+                self._check_target()
+            except (websockets.ConnectionClosed, OSError) as e:
+                # The connection is gone, so there's nothing left to publish to; keep
+                # draining until _thread_func notices and sends the end marker
+                if self._running:
+                    logging.warning("Publisher stopping: %s", e)
+                    self._running = False
+
+    async def _collect_batch(self, heart_rate: int):
+        # Coalesce everything queued within the batch window into a single frame
+        samples = [{"heartrate": heart_rate, "ts": now_cached()}]
+        deadline = time.monotonic() + self._batch_window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                heart_rate = await asyncio.wait_for(self._outq.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if heart_rate is None:
+                # Leave the end marker for _sender once this batch is out
+                self._outq.put_nowait(None)
+                break
+            samples.append({"heartrate": heart_rate, "ts": now_cached()})
+        return samples
+
+    def _check_target(self):
+        if self._target is not None and self.total_events_published >= self._target:
+            self._reached_event.set()
+
+    async def wait_for_count(self, count: int, timeout: Optional[float] = None) -> bool:
+        """ Wait until at least count events have been published, False on timeout """
+        self._target = count
+        self._reached_event.clear()
+        self._check_target()
+        try:
+            await asyncio.wait_for(self._reached_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def start(
+        self, interval: float = 1.0, batch: bool = False, batch_window: float = 0.05
+    ):
         logging.debug("Publisher thread start")
         self._interval = interval
+        self._batch = batch
+        self._batch_window = batch_window
         self._running = True
+        self._wakeup.clear()
+        self._send_task = asyncio.create_task(self._sender())
         self._run_task = asyncio.create_task(self._thread_func())
+        for task in (self._send_task, self._run_task):
+            task.add_done_callback(self._on_task_done)
+
+    def _on_task_done(self, task: asyncio.Task):
+        # Like a TaskGroup: if one task fails, the other can't be left waiting on it
+        if not task.cancelled() and task.exception() is not None:
+            for other in (self._send_task, self._run_task):
+                if other is not task:
+                    other.cancel()
 
     async def stop(self):
         logging.debug("Publisher thread stop")
         self._running = False
-        self._run_task.cancel()
+        self._wakeup.set()
+        # The failed task's sibling was cancelled by _on_task_done, so re-raise the
+        # real failure rather than that CancelledError
+        results = await asyncio.gather(
+            self._run_task, self._send_task, return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(
+                result, asyncio.CancelledError
+            ):
+                raise result
+
+
+class ClientPool:
+    """ Connected WSClients that are kept open and handed out across test cases """
+
+    def __init__(self, url: str):
+        self._url = url
+        self._clients = []
+
+    @contextlib.asynccontextmanager
+    async def checkout(self, count: int, performance_id: str):
+        # Connections the server or a proxy dropped while idle get replaced
+        dead = [c for c in self._clients if not c.is_connected]
+        if dead:
+            await asyncio.gather(*(c.close() for c in dead))
+            self._clients = [c for c in self._clients if c.is_connected]
+
+        # Only connect whatever the pool is short of, all at once
+        new_clients = [
+            heartbridge.WSClient(self._url) for _ in range(count - len(self._clients))
+        ]
+        await asyncio.gather(*(c.connect() for c in new_clients))
+        self._clients.extend(new_clients)
+
+        # Count updates caused by the previous case's unsubscribes can still arrive
+        # after this reset. That is only harmless because the cases check out ever
+        # larger sets of clients, so a stale count is always below the new target.
+        clients = self._clients[:count]
+        for c in clients:
+            c.reset()
+
+        # Every client gets the same frames, so only serialize them once
+        sub_frame = clients[0].subscribe_frame(performance_id)
+        unsub_frame = clients[0].unsubscribe_frame(performance_id)
+        await asyncio.gather(*(c.send_frame(sub_frame) for c in clients))
         try:
-            await self._run_task
-        except asyncio.exceptions.CancelledError:
-            pass
+            yield clients
+        finally:
+            # A client that dropped mid-case is replaced by the next checkout
+            await asyncio.gather(
+                *(c.send_frame(unsub_frame) for c in clients), return_exceptions=True
+            )
+
+    async def close(self):
+        await asyncio.gather(*(c.close() for c in self._clients))
+        self._clients = []
 
 
 @pytest.fixture()
@@ -52,30 +230,69 @@ def publisher(client, token):
     yield Publisher(client, token)
 
 
-@pytest.fixture()
+@pytest.fixture(scope="session")
+async def ws_pool(wsurl):
+    pool = ClientPool(wsurl)
+    yield pool
+    await pool.close()
+
+
+@pytest.fixture(scope="module")
+async def stream_publisher(client):
+    # One long-running heart rate stream that every test_ws_subscribe case attaches to
+    ret_val = await client.register(**dict(_REGISTER_KW, duration=90))
+    p = Publisher(client, orjson.loads(ret_val))
+    await p.start(interval=1.0)
+    yield p
+    await p.stop()
+
+
+@pytest.fixture(scope="session")
 async def client(wsurl) -> heartbridge.WSClient:
     logging.debug("Connecting to %s", wsurl)
-    c = heartbridge.WSClient(wsurl)
+    # The publishing client only sends tiny frames, so skip compression
+    c = heartbridge.WSClient(wsurl, compression=None)
     await c.connect()
     yield c
     logging.debug("Closing connection")
     await c.close()
 
 
-@pytest.fixture()
+@pytest.fixture(autouse=True)
+def reset_client(client):
+    # The connection is shared, so don't let one test see another's leftover frames
+    client.reset()
+
+
+@pytest.fixture(scope="module")
 async def token(client):
+    # Shared by the tests that only read it; it has to outlive the whole module
+    logging.debug("Requesting new token")
+    ret_val = await client.register(**dict(_REGISTER_KW, duration=90))
+
+    logging.debug("Returned payload: %s", ret_val)
+    p = orjson.loads(ret_val)
+    yield p
+
+
+@pytest.fixture()
+async def fresh_token(client):
+    # For tests that change the performance on the server
     logging.debug("Requesting new token")
 
     # Get a token for right now
-    ret_val = await client.register(artist=MOCK_ARTIST, title=MOCK_TITLE, duration=1)
+    ret_val = await client.register(**_REGISTER_KW)
 
     logging.debug("Returned payload: %s", ret_val)
-    p = json.loads(ret_val)
+    p = orjson.loads(ret_val)
     yield p
 
 
 @pytest.mark.asyncio
-async def test_ws_connect(client):
+async def test_ws_connect(wsurl):
+    # Uses its own connection since closing the shared client would break later tests
+    client = heartbridge.WSClient(wsurl)
+    await client.connect()
     assert client.is_connected
     logging.info("Connection established... closing connection")
     await client.close()
@@ -85,21 +302,14 @@ async def test_ws_connect(client):
 
 @pytest.mark.asyncio
 async def test_ws_invalid_action(client):
-    await client._ws.send(json.dumps({"action": "bad-action"}))
+    await client._ws.send(orjson.dumps({"action": "bad-action"}).decode())
     ret = await client.wait_for_data()
     logging.debug(ret)
 
-    assert "error" in json.loads(ret)
+    assert is_error(ret)
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize(
-    "bad_date",
-    [
-        datetime.datetime.now() - datetime.timedelta(minutes=6),
-        datetime.datetime.now() + datetime.timedelta(days=367),
-    ],
-)
 async def test_ws_register_bad_date(client, bad_date):
     ret = await client.register(
         artist=MOCK_ARTIST,
@@ -108,19 +318,19 @@ async def test_ws_register_bad_date(client, bad_date):
         duration=1,
     )
     logging.debug(ret)
-    assert "error" in json.dumps(ret)
+    assert is_error(ret)
 
 
 @pytest.mark.asyncio
 async def test_ws_register_bad_artist(client):
     ret = await client.register(
-        artist="A" * 65,
-        title="B" * 65,
+        artist=BAD_ARTIST,
+        title=BAD_TITLE,
         performance_date=datetime.datetime.now().timestamp(),
         duration=1,
     )
     logging.debug(ret)
-    assert "error" in json.dumps(ret)
+    assert is_error(ret)
 
 
 def test_ws_register(token):
@@ -134,7 +344,7 @@ def test_ws_register(token):
     assert len(performance_id) == 6
 
     # Decode the token
-    token_claims = jwt.decode(token["token"], verify=False)
+    token_claims = decode_token(token["token"])
     logging.debug(token_claims)
 
     assert token_claims["artist"] == MOCK_ARTIST
@@ -145,20 +355,17 @@ def test_ws_register(token):
 @pytest.mark.parametrize(
     "field,new_value", [("artist", "DJFurioso"), ("title", "A Fresh Title")]
 )
-async def test_ws_update(client, token, field, new_value):
+async def test_ws_update(client, fresh_token, field, new_value):
     """ Register a performance, then update information """
-    performance_id = token["performance_id"]
+    performance_id = fresh_token["performance_id"]
     logging.info("PerformanceID: %s", performance_id)
 
-    orig_token_claims = jwt.decode(token["token"], verify=False)
-    logging.debug(orig_token_claims)
-
     # Update the field information
-    ret_val = await client.update(token["token"], {field: new_value})
-    p = json.loads(ret_val)
+    ret_val = await client.update(fresh_token["token"], {field: new_value})
+    p = orjson.loads(ret_val)
 
     # Make sure an error wasn't returned
-    if "error" in p:
+    if is_error(p):
         logging.debug(p)
         assert False
 
@@ -166,7 +373,7 @@ async def test_ws_update(client, token, field, new_value):
     assert p["performance_id"] == performance_id
 
     # Check to make sure the new artist information is in the new token
-    new_token_claims = jwt.decode(p["token"], verify=False)
+    new_token_claims = decode_token(p["token"])
     logging.debug(new_token_claims)
     assert new_token_claims[field] == new_value
 
@@ -174,22 +381,18 @@ async def test_ws_update(client, token, field, new_value):
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
     "field,new_value",
-    [("artist", "DJFurioso" * 65), ("token", "ABC123456890"), ("performance_date", 0)],
+    [("artist", LONG_ARTIST), ("token", "ABC123456890"), ("performance_date", 0)],
 )
 async def test_ws_update_bad_values(client, token, field, new_value):
     """ Register a performance, then update information with bad values """
     performance_id = token["performance_id"]
     logging.info("PerformanceID: %s", performance_id)
 
-    orig_token_claims = jwt.decode(token["token"], verify=False)
-    logging.debug(orig_token_claims)
-
     # Update the field information
     ret_val = await client.update(token["token"], {field: new_value})
-    p = json.loads(ret_val)
 
     # Make sure an error was returned
-    assert "error" in p, "Oops, we expected to get an error returned here"
+    assert is_error(ret_val), "Oops, we expected to get an error returned here"
 
 
 @pytest.mark.asyncio
@@ -197,38 +400,37 @@ async def test_ws_publish(publisher: Publisher):
     """ Test publishing heartrate """
 
     await publisher.start(interval=0.1)
-    await asyncio.sleep(5)
+    assert await publisher.wait_for_count(40, timeout=6)
     await publisher.stop()
+    assert publisher.total_events_published >= 40
 
 
 @pytest.mark.asyncio
 async def test_ws_bad_subscribe(client):
     await client.subscribe("ABC1234")
     ret = await client.wait_for_data()
-    p = json.loads(ret)
     logging.debug(ret)
-    assert "error" in p, "Oops, we expected to get an error returned here"
+    assert is_error(ret), "Oops, we expected to get an error returned here"
 
 
 @pytest.mark.asyncio
-async def test_ws_publish_before_nbf(client: heartbridge.WSClient, token):
+async def test_ws_publish_before_nbf(client: heartbridge.WSClient, fresh_token):
     """ Test publishing heartrate before the start time of the performance """
-    token = token["token"]
+    token = fresh_token["token"]
 
     # Update the token so that it is only valid starting tomorrow
     new_performance_time = datetime.datetime.now() + datetime.timedelta(days=1)
     ret_val = await client.update(
         token, {"performance_date": new_performance_time.timestamp()}
     )
-    token = json.loads(ret_val)["token"]
+    token = orjson.loads(ret_val)["token"]
 
     # Attempt to publish a heartrate
     await client.publish(token, 100)
 
     # Ensure that an error message was returned
     ret_val = await client.wait_for_data()
-    p = json.loads(ret_val)
-    assert "error" in p, "Oops, we expected to get an error returned here"
+    assert is_error(ret_val), "Oops, we expected to get an error returned here"
 
 
 @pytest.mark.asyncio
@@ -239,8 +441,7 @@ async def test_ws_publish_with_expired_token(client: heartbridge.WSClient):
     await client.publish(EXPIRED_TOKEN, 100)
 
     ret_val = await client.wait_for_data()
-    p = json.loads(ret_val)
-    assert "error" in p, "Oops, we expected to get an error returned here"
+    assert is_error(ret_val), "Oops, we expected to get an error returned here"
 
 
 @pytest.mark.asyncio
@@ -250,82 +451,102 @@ async def test_ws_publish_to_disconnected_sub(publisher: Publisher, wsurl: str):
     await client.subscribe(publisher.performance_id)
 
     await publisher.start(0.1)
-    await asyncio.sleep(1.0)
+    assert await publisher.wait_for_count(10, timeout=5)
     await client.close()
-    await asyncio.sleep(1.0)
+
+    # Publishing has to carry on once the subscriber is gone
+    target = publisher.total_events_published + 10
+    assert await publisher.wait_for_count(target, timeout=5)
 
     await publisher.stop()
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("num_subscriptions", [1, 2, 10, 100, 1000])
-async def test_ws_subscribe(publisher: Publisher, wsurl, num_subscriptions):
-    # This is the main loop for subscribers
-    async def client_loop(tclient: heartbridge.WSClient, performance_id: str):
-        await tclient.subscribe(performance_id)
-
-        num_rx = 0
-        max_subs = 0
+@pytest.mark.parametrize(
+    "num_subscriptions", [10, 100, 1000], ids=lambda n: f"{n}-subscribers"
+)
+async def test_ws_subscribe(
+    stream_publisher: Publisher, ws_pool: ClientPool, num_subscriptions
+):
+    # This is the main loop for subscribers, stats is [num_rx, max_subs]; the last
+    # subscriber to see the full subscription count sets all_subscribed
+    async def client_loop(tclient: heartbridge.WSClient, stats):
+        debug_enabled = _log.isEnabledFor(logging.DEBUG)
         while True:
-            logging.debug("Client: %s", tclient.connection_id)
             try:
                 ret = await tclient.wait_for_data()
-                p = json.loads(ret)
-                if p["action"] == "heartrate_update":
-                    logging.debug(
-                        "Client: %s -- Got heart rate update: %s",
-                        tclient.connection_id,
-                        p["heartrate"],
-                    )
-                    num_rx += 1
-                if p["action"] == "subscriber_count_update":
-                    logging.debug(
-                        "Client: %s -- Active Subcriptions: %s",
-                        tclient.connection_id,
-                        p["active_subscriptions"],
-                    )
+                action = _peek_action(ret)
+                if action == "heartrate_update":
+                    if debug_enabled:
+                        _log.debug(
+                            "Client: %s -- Got heart rate update: %s",
+                            tclient.connection_id,
+                            orjson.loads(ret)["heartrate"],
+                        )
+                    stats[0] += 1
+                elif action == "subscriber_count_update":
+                    p = orjson.loads(ret)
+                    if debug_enabled:
+                        _log.debug(
+                            "Client: %s -- Active Subcriptions: %s",
+                            tclient.connection_id,
+                            p["active_subscriptions"],
+                        )
                     sub_cnt = int(p["active_subscriptions"])
-                    if sub_cnt > max_subs:
-                        max_subs = sub_cnt
+                    if sub_cnt > stats[1]:
+                        if stats[1] < num_subscriptions <= sub_cnt:
+                            ready[0] += 1
+                            if ready[0] == num_subscriptions:
+                                all_subscribed.set()
+                        stats[1] = sub_cnt
 
             except Exception:
-                # Capture any exception and use that to return here.  The expectation is that we will
-                # get a socket closed exception when the main test body closes all of the connections down
-                return num_rx, max_subs
-
-    # Set up all of the subscribers...
-    clients = []
-    for i in range(num_subscriptions):
-        # Create the client
-        logging.debug("Connecting to: %s", wsurl)
-        client = heartbridge.WSClient(wsurl)
-        await client.connect()
-
-        # Submit the client run loop to the thread pool
-        t = asyncio.create_task(client_loop(client, publisher.performance_id))
-
-        # Store it
-        clients.append((client, t))
-
-    # Start the publisher
-    await asyncio.sleep(1)
-    await publisher.start(interval=1.0)
-
-    # After a certain number of events, have the publisher stop
-    while True:
-        await asyncio.sleep(0.1)
-        if publisher.total_events_published == 10:
-            break
+                # A dropped connection ends this subscriber early; the counts show it
+                return
 
-    await publisher.stop()
-    await asyncio.sleep(1)
-
-    # Shutdown each subscriber connection (which will terminate their thread) and gather up the results
-    total_num_rx = 0
-    for iclient, t in clients:
-        await iclient.close()
-        num_rx, max_subs = await t
-        total_num_rx += num_rx
-        assert max_subs == num_subscriptions
+    # Take connected subscribers from the pool, they are unsubscribed again on exit
+    async with ws_pool.checkout(
+        num_subscriptions, stream_publisher.performance_id
+    ) as clients:
+        stats = [[0, 0] for _ in clients]
+        ready = [0]
+        all_subscribed = asyncio.Event()
 
-    assert total_num_rx == publisher.total_events_published * num_subscriptions
+        # One long-lived receive coroutine per subscriber, all scheduled at once
+        loops = asyncio.gather(*(client_loop(c, st) for c, st in zip(clients, stats)))
+
+        try:
+            # Wait until every subscriber has seen the full count
+            try:
+                await asyncio.wait_for(all_subscribed.wait(), timeout=30)
+            except asyncio.TimeoutError:
+                pass
+            lagging = [
+                c.connection_id
+                for c, st in zip(clients, stats)
+                if st[1] < num_subscriptions
+            ]
+            assert not lagging, "%d subscribers never saw all %d subscriptions: %s" % (
+                len(lagging),
+                num_subscriptions,
+                lagging[:10],
+            )
+
+            # Every subscriber has to receive everything published from here on
+            rx_start = [st[0] for st in stats]
+            published_start = stream_publisher.total_events_published
+            target = published_start + 10
+            assert await stream_publisher.wait_for_count(target, timeout=30)
+            published = stream_publisher.total_events_published - published_start
+            await asyncio.sleep(1)
+        finally:
+            # The connections stay open for the next case, so stop the loops directly
+            loops.cancel()
+            try:
+                await loops
+            except asyncio.CancelledError:
+                pass
+
+    for (num_rx, max_subs), start in zip(stats, rx_start):
+        assert num_rx - start >= published
+        assert max_subs == num_subscriptions